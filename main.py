@@ -1,11 +1,26 @@
+import argparse
+import collections
+import concurrent.futures
 import csv
+import hashlib
+import http.client
+import importlib
+import io
+import math
+import multiprocessing
 import os
+import queue
+import re
 import shutil
 import sys
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
 
 import numpy as np
 from PyQt5 import QtWidgets
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QThread, pyqtSignal
 from PyQt5.QtGui import QPixmap, QImage, QIntValidator, QKeySequence
 from PyQt5.QtWidgets import QApplication, QWidget, QLabel, QCheckBox, QFileDialog, QDesktopWidget, QLineEdit, \
     QRadioButton, QShortcut, QScrollArea, QVBoxLayout, QGroupBox, QFormLayout, QSizePolicy, QAction, QMenu, QMainWindow
@@ -13,6 +28,27 @@ from PyQt5.QtWidgets import QApplication, QWidget, QLabel, QCheckBox, QFileDialo
 from PIL import Image
 from pydicom import dcmread
 
+# settings for images read over HTTP (S3-compatible object storage)
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pyqt-image-annotation-tool')
+CACHE_MAX_BYTES = 2 * 1024 ** 3  # downloaded images kept on disk
+HTTP_POOL_SIZE = 8  # max simultaneous keep-alive connections
+PREFETCH_WORKERS = 4
+DICOM_HEADER_BYTES = 64 * 1024  # first range read when only DICOM metadata is needed
+
+# settings for prefetching the upcoming images (background download or OS readahead)
+PREFETCH_DEPTH = 4  # how many upcoming images are prefetched at start
+PREFETCH_MIN_DEPTH = 2
+PREFETCH_MAX_DEPTH = 32
+SLOW_READ_SECONDS = 0.05  # prefetch depth grows by PREFETCH_MIN_DEPTH for every this much storage latency
+
+# settings for model-assisted pre-labeling
+PRELABEL_BATCH_SIZE = 32
+PRELABEL_BATCHES_PER_TASK = 4  # batches sent to a worker process at a time
+PRELABEL_INPUT_SIZE = 224  # used when the model doesn't define its input size
+SUGGESTION_THRESHOLD = 0.5  # labels with at least this probability are suggested
+PRELABEL_STOP_POLL_SECONDS = 0.1  # how often a stop request is checked while waiting for the workers
+
+
 def get_img_paths(dir, extensions=('.png', 'jpg', '.jpeg', 'dcm')):
     '''
     :param dir: folder with files
@@ -28,6 +64,31 @@ def get_img_paths(dir, extensions=('.png', 'jpg', '.jpeg', 'dcm')):
     return img_paths
 
 
+def natural_sort_key(path):
+    """
+    Sort key which compares numbers by value, e.g. img2.png comes before img10.png
+    """
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', path)]
+
+
+def sort_img_paths(img_paths, order, locality_key=None):
+    """
+    :param img_paths: image paths in listing order
+    :param order: 'listing' (keep the order), 'natural' (natural filename order) or 'locality' (order of the
+        files on disk, so that spinning disks and NFS read mostly sequentially)
+    :param locality_key: sort key giving the on-disk position of a path, see LocalImageSource.locality_key.
+        None if the images have no on-disk order, then 'locality' falls back to natural order.
+    :return: sorted list of paths
+    """
+    if order == 'listing':
+        return list(img_paths)
+
+    img_paths = sorted(img_paths, key=natural_sort_key)
+    if order == 'locality' and locality_key is not None:
+        img_paths.sort(key=locality_key)
+    return img_paths
+
+
 def make_folder(directory):
     """
     Make folder if it doesn't already exist
@@ -37,6 +98,863 @@ def make_folder(directory):
         os.makedirs(directory)
 
 
+def get_image_source(location):
+    """
+    Creates the image source matching the location selected by the user
+    :param location: local folder or http(s) url of a bucket/prefix in S3-compatible storage
+    :return: LocalImageSource or HttpImageSource
+    """
+    if location.lower().startswith(('http://', 'https://')):
+        return HttpImageSource(location)
+    return LocalImageSource(location)
+
+
+def read_dicom_header(image_source, path, num_bytes=DICOM_HEADER_BYTES):
+    """
+    Reads DICOM metadata without the pixel data. Only the beginning of the file is read and the read
+    is retried with a larger range if the header doesn't fit into it.
+    :param image_source: source the image belongs to
+    :param path: path (or key) of the DICOM file
+    :param num_bytes: size of the first range read
+    :return: pydicom dataset without pixel data
+    """
+    while True:
+        data = image_source.read_range(path, 0, num_bytes)
+        f = io.BytesIO(data)
+        try:
+            ds = dcmread(f, stop_before_pixels=True)
+            # reading stops before the pixel data, so if all the bytes were used the header was cut off
+            if len(data) < num_bytes or f.tell() < len(data):
+                return ds
+        except Exception:
+            # the whole file was read already, so the file itself is broken
+            if len(data) < num_bytes:
+                raise
+        num_bytes *= 4
+
+
+class LatencyTracker:
+    """
+    Thread-safe record of storage latency. Only reads which had to wait for the storage are recorded
+    (readahead, downloads and reads of files that weren't prefetched), not reads of already prefetched files.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}  # {path: seconds of the latest storage read}
+        self.average = None  # exponential moving average
+        self.count = 0
+
+    def record(self, path, seconds):
+        with self.lock:
+            self.latencies[path] = seconds
+            self.count += 1
+            if self.average is None:
+                self.average = seconds
+            else:
+                self.average = 0.8 * self.average + 0.2 * seconds
+
+    def slowest(self, n=5):
+        """:return: list of (path, seconds) of the slowest reads"""
+        with self.lock:
+            return sorted(self.latencies.items(), key=lambda item: item[1], reverse=True)[:n]
+
+
+class LocalImageSource:
+    """
+    Images in a folder of the local file system. Paths are used as they are.
+    """
+
+    def __init__(self, folder):
+        self.location = folder
+        self.output_folder = os.path.join(folder, 'output')
+
+        # recently hinted paths, so that the same files aren't opened again on every image change
+        self.hinted = collections.OrderedDict()
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='readahead')
+        self.latency = LatencyTracker()
+
+    def list_images(self, extensions=('.png', 'jpg', '.jpeg', 'dcm'), progress=None, should_stop=None):
+        """
+        The folder is listed at once, so progress and should_stop are not used
+        """
+        return get_img_paths(self.location, extensions)
+
+    @staticmethod
+    def locality_key(path):
+        """On-disk order of the file, approximated by device and inode number"""
+        try:
+            stat = os.stat(path)
+            return stat.st_dev, stat.st_ino
+        except OSError:
+            return 0, 0
+
+    def fetch(self, path, hold=False):
+        """:return: local path of the image"""
+        return path
+
+    def release(self, paths):
+        """local files are never removed"""
+        pass
+
+    def read(self, path):
+        """:return: contents of the file"""
+        start = time.perf_counter()
+        with open(path, 'rb') as f:
+            data = f.read()
+        # files which weren't read ahead show how slow the storage is
+        if path not in self.hinted:
+            self.latency.record(path, time.perf_counter() - start)
+        return data
+
+    def read_range(self, path, start, end):
+        """:return: bytes start..end-1 of the file"""
+        with open(path, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def prefetch(self, paths):
+        """
+        Asks the OS to start reading the files into the page cache (readahead). Opening the files
+        is done in a background thread since it can be slow on network file systems.
+        """
+        # not available on Windows and macOS
+        if not hasattr(os, 'posix_fadvise'):
+            return
+
+        paths = [path for path in paths if path not in self.hinted]
+        for path in paths:
+            self.hinted[path] = True
+        while len(self.hinted) > 4 * PREFETCH_MAX_DEPTH:
+            self.hinted.popitem(last=False)
+        if paths:
+            self.executor.submit(self._advise_willneed, paths)
+
+    def _advise_willneed(self, paths):
+        for path in paths:
+            try:
+                start = time.perf_counter()
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                    # fadvise doesn't wait for the data, reading the first block measures the storage latency
+                    os.pread(fd, 4096, 0)
+                finally:
+                    os.close(fd)
+                self.latency.record(path, time.perf_counter() - start)
+            except OSError:
+                pass
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class DiskByteCache:
+    """
+    Size-bounded cache of downloaded files. When the size limit is exceeded the least recently used
+    files are removed. Files are kept between sessions, so every file is stored with a version (e.g. ETag)
+    and a changed object is downloaded again instead of using the old file.
+    """
+
+    def __init__(self, directory, max_bytes):
+        make_folder(directory)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        # {filename: size}, least recently used first
+        self.entries = collections.OrderedDict()
+        # {filename: count} of files in use which must not be evicted
+        self.held = collections.Counter()
+        files = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith('.tmp'):
+                # left over from an interrupted download
+                os.remove(entry.path)
+            elif entry.is_file():
+                files.append((entry.stat().st_mtime, entry.name, entry.stat().st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+        self.size = sum(self.entries.values())
+        self._evict()
+
+    @staticmethod
+    def _filename(key, version):
+        # keep the file ending so that the image type can be recognized from the cached file
+        name = hashlib.sha1(f'{key}\n{version}'.encode('utf-8')).hexdigest()
+        return name + os.path.splitext(key)[1].lower()
+
+    def contains(self, key, version=''):
+        with self.lock:
+            return self._filename(key, version) in self.entries
+
+    def get(self, key, version='', hold=False):
+        """
+        :param hold: keep the file in the cache until it is released
+        :return: path of the cached file or None if this version of the key isn't cached
+        """
+        name = self._filename(key, version)
+        path = os.path.join(self.directory, name)
+        with self.lock:
+            if name not in self.entries:
+                return None
+            try:
+                # modification time tells the usage order in the next session
+                os.utime(path)
+            except FileNotFoundError:
+                # removed outside of the app
+                self.size -= self.entries.pop(name)
+                return None
+            self.entries.move_to_end(name)
+            if hold:
+                self.held[name] += 1
+        return path
+
+    def put(self, key, data, version='', hold=False):
+        """
+        Saves the data to the cache
+        :param hold: keep the file in the cache until it is released
+        :return: path of the cached file
+        """
+        name = self._filename(key, version)
+        path = os.path.join(self.directory, name)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.size += len(data) - self.entries.pop(name, 0)
+            self.entries[name] = len(data)
+            if hold:
+                self.held[name] += 1
+            self._evict()
+        return path
+
+    def release(self, path):
+        """Allows a held file to be evicted again"""
+        name = os.path.basename(path)
+        with self.lock:
+            self.held[name] -= 1
+            if self.held[name] <= 0:
+                del self.held[name]
+                self._evict()
+
+    def _evict(self):
+        if self.size <= self.max_bytes:
+            return
+        # the newest file is kept even if it alone is larger than the limit, and held files are skipped
+        for name in list(self.entries)[:-1]:
+            if self.size <= self.max_bytes:
+                break
+            if name in self.held:
+                continue
+            self.size -= self.entries.pop(name)
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+
+class HttpConnectionPool:
+    """
+    Thread-safe pool of keep-alive connections to a single host
+    """
+
+    def __init__(self, scheme, netloc, size=HTTP_POOL_SIZE, timeout=30):
+        if scheme == 'https':
+            self.connection_class = http.client.HTTPSConnection
+        else:
+            self.connection_class = http.client.HTTPConnection
+        self.netloc = netloc
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def request(self, method, url, headers=None):
+        """
+        Sends a request using an idle connection if there is one
+        :return: status, response headers and the response body
+        """
+        with self.slots:
+            try:
+                conn, reused = self.idle.get_nowait(), True
+            except queue.Empty:
+                conn, reused = self.connection_class(self.netloc, timeout=self.timeout), False
+
+            while True:
+                try:
+                    conn.request(method, url, headers=headers or {})
+                    response = conn.getresponse()
+                    body = response.read()
+                    break
+                except (http.client.HTTPException, OSError) as e:
+                    conn.close()
+                    # the server may have closed an idle keep-alive connection, retry once with a new one
+                    if not reused:
+                        raise OSError(f'{method} {self.netloc}{url} failed: {e}') from e
+                    conn, reused = self.connection_class(self.netloc, timeout=self.timeout), False
+
+            if response.will_close:
+                conn.close()
+            else:
+                self.idle.put(conn)
+            return response.status, response.headers, body
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class HttpImageSource:
+    """
+    Images in S3-compatible object storage (e.g. MinIO) read over HTTP. The location is given as
+    http(s)://host/bucket/prefix. Requests are not signed, so the bucket has to allow anonymous reads.
+    Images are downloaded to a disk cache and upcoming images can be prefetched in the background.
+    """
+
+    # objects have no on-disk order, see sort_img_paths
+    locality_key = None
+
+    def __init__(self, url, cache_dir=CACHE_DIR, cache_max_bytes=CACHE_MAX_BYTES, prefetch_workers=PREFETCH_WORKERS):
+        parts = urllib.parse.urlsplit(url)
+        self.location = url
+        self.bucket, _, self.prefix = parts.path.strip('/').partition('/')
+        if self.prefix:
+            self.prefix += '/'
+
+        self.output_folder = os.path.join(os.getcwd(), 'output', self.bucket)
+        self.pool = HttpConnectionPool(parts.scheme, parts.netloc)
+        cache_name = hashlib.sha1(f'{parts.netloc}/{self.bucket}'.encode('utf-8')).hexdigest()
+        self.cache = DiskByteCache(os.path.join(cache_dir, cache_name), cache_max_bytes)
+
+        # {key: ETag} from the listing, used as the version of the cached files
+        self.etags = {}
+        # {key: future} of the background downloads in progress
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(prefetch_workers, thread_name_prefix='prefetch')
+        self.latency = LatencyTracker()
+
+    def _object_url(self, key):
+        return f'/{self.bucket}/{urllib.parse.quote(key)}'
+
+    def list_images(self, extensions=('.png', 'jpg', '.jpeg', 'dcm'), progress=None, should_stop=None):
+        """
+        Lists the images directly under the prefix (ListObjectsV2, one page at a time)
+        :param progress: function called with the number of listed pages and images after each page
+        :param should_stop: function telling if listing should be stopped, checked between pages
+        :return: list of object keys, None if listing was stopped
+        """
+        img_paths = []
+        token = None
+        pages = 0
+        while True:
+            if should_stop and should_stop():
+                return None
+            query = {'list-type': '2', 'prefix': self.prefix, 'delimiter': '/'}
+            if token:
+                query['continuation-token'] = token
+            status, _, body = self.pool.request('GET', f'/{self.bucket}?{urllib.parse.urlencode(query)}')
+            if status != 200:
+                raise OSError(f'Listing {self.location} failed with HTTP status {status}')
+
+            # ignore the S3 xml namespace
+            root = ElementTree.fromstring(body)
+            for element in root.iter():
+                element.tag = element.tag.rsplit('}', 1)[-1]
+
+            for contents in root.findall('Contents'):
+                key = contents.findtext('Key')
+                if key.lower().endswith(extensions):
+                    img_paths.append(key)
+                    self.etags[key] = contents.findtext('ETag', '')
+
+            pages += 1
+            if progress:
+                progress(pages, len(img_paths))
+            if root.findtext('IsTruncated') != 'true':
+                return img_paths
+            token = root.findtext('NextContinuationToken')
+
+    def _download(self, key, hold=False):
+        start = time.perf_counter()
+        status, headers, body = self.pool.request('GET', self._object_url(key))
+        self.latency.record(key, time.perf_counter() - start)
+        if status != 200:
+            raise OSError(f'Downloading {key} failed with HTTP status {status}')
+        # the object may have changed after listing, store it with the ETag it was downloaded with
+        etag = headers.get('ETag', self.etags.get(key, ''))
+        self.etags[key] = etag
+        return self.cache.put(key, body, etag, hold)
+
+    def fetch(self, key, hold=False):
+        """
+        Waits for the image to be in the disk cache
+        :param hold: keep the file in the cache until it is released
+        :return: local path of the cached image
+        """
+        path = self.cache.get(key, self.etags.get(key, ''), hold)
+        if path is not None:
+            return path
+
+        with self.lock:
+            future = self.pending.get(key)
+        if future is not None:
+            try:
+                future.result()
+            except OSError:
+                pass  # try again below
+            path = self.cache.get(key, self.etags.get(key, ''), hold)
+            if path is not None:
+                return path
+        return self._download(key, hold)
+
+    def release(self, paths):
+        """Allows the held files returned by fetch to be evicted from the cache"""
+        for path in paths:
+            self.cache.release(path)
+
+    def read(self, key):
+        """:return: contents of the object"""
+        try:
+            with open(self.fetch(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            # evicted by a background download right after fetching
+            with open(self._download(key), 'rb') as f:
+                return f.read()
+
+    def read_range(self, key, start, end):
+        """:return: bytes start..end-1 of the object"""
+        path = self.cache.get(key, self.etags.get(key, ''))
+        if path is not None:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                return f.read(end - start)
+
+        status, _, body = self.pool.request('GET', self._object_url(key), {'Range': f'bytes={start}-{end - 1}'})
+        if status == 200:
+            # the server doesn't support range requests and sent the whole object
+            return body[start:end]
+        if status == 206:
+            return body
+        if status == 416:
+            # range starts after the end of the object
+            return b''
+        raise OSError(f'Reading {key} failed with HTTP status {status}')
+
+    def prefetch(self, keys):
+        """Starts downloading images which are not already cached or being downloaded"""
+        for key in keys:
+            if self.cache.contains(key, self.etags.get(key, '')):
+                continue
+            with self.lock:
+                if key in self.pending:
+                    continue
+                future = self.executor.submit(self._download, key)
+                self.pending[key] = future
+            future.add_done_callback(lambda f, key=key: self._forget(key))
+
+    def _forget(self, key):
+        with self.lock:
+            self.pending.pop(key, None)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.pool.close()
+
+
+class ReadScheduler:
+    """
+    Prefetches the next images in the navigation direction. The prefetch depth follows the storage latency
+    measured by the image source, so slow storage is prefetched further ahead.
+    """
+
+    def __init__(self, image_source):
+        self.image_source = image_source
+
+    @property
+    def depth(self):
+        average = self.image_source.latency.average
+        if average is None:
+            return PREFETCH_DEPTH
+        depth = math.ceil(average / SLOW_READ_SECONDS) * PREFETCH_MIN_DEPTH
+        return min(max(depth, PREFETCH_MIN_DEPTH), PREFETCH_MAX_DEPTH)
+
+    def prefetch(self, img_paths, index, direction):
+        """
+        Prefetches the images following the current one
+        :param img_paths: all images in navigation order
+        :param index: index of the current image
+        :param direction: 1 when moving forward, -1 when moving backward
+        """
+        if direction > 0:
+            upcoming = img_paths[index + 1:index + 1 + self.depth]
+        else:
+            upcoming = img_paths[max(index - self.depth, 0):index][::-1]
+        self.image_source.prefetch(upcoming)
+
+    def stats_text(self):
+        latency = self.image_source.latency
+        if latency.average is None:
+            return ''
+        return (f'Storage: {1000 * latency.average:.1f} ms avg over {latency.count} reads, '
+                f'prefetching {self.depth} images')
+
+
+def load_model(model_spec, threads=None):
+    """
+    Loads the model used for pre-labeling
+    :param model_spec: path to an ONNX model or 'module:function'. The function gets a float32 array of shape
+        (batch, 3, height, width) with values 0-1 and returns an array of shape (batch, number of labels)
+    :param threads: number of threads an ONNX model may use, by default all CPUs
+    :return: predict function and the input image size
+    """
+    if model_spec.lower().endswith('.onnx'):
+        # onnxruntime is only needed when an ONNX model is used
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = threads
+        session = onnxruntime.InferenceSession(model_spec, options, providers=['CPUExecutionProvider'])
+        model_input = session.get_inputs()[0]
+        input_size = model_input.shape[-1]
+        if not isinstance(input_size, int):
+            input_size = PRELABEL_INPUT_SIZE
+
+        def predict(images):
+            return session.run(None, {model_input.name: images})[0]
+
+        return predict, input_size
+
+    module_name, _, function_name = model_spec.partition(':')
+    predict = getattr(importlib.import_module(module_name), function_name)
+    return predict, PRELABEL_INPUT_SIZE
+
+
+def load_image_array(path, size):
+    """
+    Decodes an image for the model
+    :return: float32 array of shape (3, size, size) with values 0-1
+    """
+    if path.lower().endswith('.dcm'):
+        img = Image.fromarray(LabelerWindow.scale_dicom(path))
+    else:
+        img = Image.open(path)
+    img = img.convert('RGB').resize((size, size))
+    return np.asarray(img, dtype=np.float32).transpose(2, 0, 1) / 255.0
+
+
+def decode_batch(paths, size):
+    """
+    :return: array of the decoded images and a boolean array telling which images could be decoded
+    """
+    images = np.zeros((len(paths), 3, size, size), dtype=np.float32)
+    valid = np.zeros(len(paths), dtype=bool)
+    for i, path in enumerate(paths):
+        if path is None:
+            continue
+        try:
+            images[i] = load_image_array(path, size)
+            valid[i] = True
+        except Exception as e:
+            print(f"Can't decode {path}: {e}")
+    return images, valid
+
+
+# models loaded in a worker process {model_spec: (predict, input size)}
+_worker_models = {}
+
+
+def to_probabilities(output, model_output):
+    """
+    Converts the model output to probabilities
+    :param output: model output of shape (batch, labels)
+    :param model_output: 'probabilities' (used as is), 'logits' (softmax over the labels, sigmoid when the model
+        has a single output) or 'sigmoid-logits' (sigmoid for each label, for multi-label models)
+    :return: probabilities of shape (batch, labels)
+    """
+    if model_output == 'logits' and output.shape[1] > 1:
+        output = np.exp(output - output.max(axis=1, keepdims=True))
+        return output / output.sum(axis=1, keepdims=True)
+
+    if model_output in ('logits', 'sigmoid-logits'):
+        with np.errstate(over='ignore'):
+            return 1 / (1 + np.exp(-output))
+
+    if output.min() < 0 or output.max() > 1:
+        raise ValueError('Model output is not probabilities (0-1), use --model-output logits or sigmoid-logits')
+    return output
+
+
+def prelabel_task(model_spec, model_output, paths, start, predictions_path):
+    """
+    Runs the model for a part of the dataset in a worker process. The next batch is decoded
+    while the model is running, and the probabilities are written to the memory-mapped predictions file.
+    :param model_output: type of the model output, see to_probabilities
+    :param paths: local paths of the images, None for images which couldn't be read
+    :param start: row of the first image in the predictions file
+    :return: number of processed images
+    """
+    if model_spec not in _worker_models:
+        # every worker process runs one batch at a time, so more threads would only oversubscribe the CPU
+        _worker_models[model_spec] = load_model(model_spec, threads=1)
+    predict, input_size = _worker_models[model_spec]
+
+    predictions = np.load(predictions_path, mmap_mode='r+')
+    num_labels = predictions.shape[1]
+    batches = [paths[i:i + PRELABEL_BATCH_SIZE] for i in range(0, len(paths), PRELABEL_BATCH_SIZE)]
+
+    with concurrent.futures.ThreadPoolExecutor(1) as decoder:
+        next_batch = decoder.submit(decode_batch, batches[0], input_size)
+        for i in range(len(batches)):
+            images, valid = next_batch.result()
+            if i + 1 < len(batches):
+                next_batch = decoder.submit(decode_batch, batches[i + 1], input_size)
+
+            output = np.asarray(predict(images), dtype=np.float32)
+            if output.shape != (len(images), num_labels):
+                raise ValueError(f'Model output has shape {output.shape}, expected ({len(images)}, {num_labels})')
+
+            probabilities = to_probabilities(output, model_output)
+            probabilities[~valid] = np.nan
+            row = start + i * PRELABEL_BATCH_SIZE
+            predictions[row:row + len(images)] = probabilities
+
+    predictions.flush()
+    return len(paths)
+
+
+def prelabel(model_spec, image_source, img_paths, num_labels, predictions_path, model_output='probabilities',
+             progress=None, should_stop=None, workers=None):
+    """
+    Predicts label probabilities for all images with a pool of worker processes
+    :param model_spec: model for load_model
+    :param image_source: source of the images
+    :param img_paths: images to predict
+    :param num_labels: number of labels the model predicts
+    :param predictions_path: .npy file where the probabilities are saved
+    :param model_output: type of the model output, see to_probabilities
+    :param progress: function called with the number of processed images and the number of all images
+    :param should_stop: function telling if pre-labeling should be stopped, checked also while waiting for tasks
+    :param workers: number of worker processes, by default the number of CPUs
+    :return: memory-mapped array of shape (images, labels), rows of failed images are NaN.
+        None if pre-labeling was stopped.
+    """
+    # load the model here too to find errors before starting the workers
+    load_model(model_spec)
+
+    make_folder(os.path.dirname(predictions_path))
+    predictions = np.lib.format.open_memmap(predictions_path, mode='w+', dtype=np.float32,
+                                            shape=(len(img_paths), num_labels))
+    predictions[:] = np.nan
+    predictions.flush()
+    del predictions
+
+    workers = workers or os.cpu_count()
+    task_size = PRELABEL_BATCH_SIZE * PRELABEL_BATCHES_PER_TASK
+    done = 0
+
+    # {future: local paths} of the submitted tasks. The files are held in the image source's cache
+    # until the task has decoded them.
+    running = {}
+
+    def wait_for_tasks(max_running):
+        """
+        :return: False if pre-labeling was stopped while waiting
+        """
+        nonlocal done
+        while len(running) > max_running:
+            if should_stop and should_stop():
+                return False
+            finished, _ = concurrent.futures.wait(running, timeout=PRELABEL_STOP_POLL_SECONDS,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                image_source.release([path for path in running.pop(future) if path is not None])
+                done += future.result()
+            if finished and progress:
+                progress(done, len(img_paths))
+        return True
+
+    # worker processes are started with spawn, forking the threads of Qt and the image source is not safe
+    pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+    completed = False
+    try:
+        for start in range(0, len(img_paths), task_size):
+            if should_stop and should_stop():
+                return None
+
+            # download the images of the next task while this one is running
+            image_source.prefetch(img_paths[start + task_size:start + 2 * task_size])
+
+            paths = []
+            for path in img_paths[start:start + task_size]:
+                try:
+                    paths.append(image_source.fetch(path, hold=True))
+                except OSError as e:
+                    print("Can't load image:", e)
+                    paths.append(None)
+            running[pool.submit(prelabel_task, model_spec, model_output, paths, start, predictions_path)] = paths
+
+            # keep only a limited number of tasks waiting
+            if not wait_for_tasks(workers):
+                return None
+        if not wait_for_tasks(0):
+            return None
+        completed = True
+    finally:
+        # if a task failed or pre-labeling was stopped, the running tasks are not waited for
+        pool.shutdown(wait=completed, cancel_futures=True)
+        for paths in running.values():
+            image_source.release([path for path in paths if path is not None])
+
+    return np.load(predictions_path, mmap_mode='r')
+
+
+def uncertainty_order(probabilities, method='entropy', multi_label=False):
+    """
+    Orders images so that the ones the model is least sure about come first
+    :param probabilities: array of shape (images, labels)
+    :param method: 'entropy' (entropy of the normalized probabilities) or 'margin' (difference of the two
+        most probable labels)
+    :param multi_label: probabilities are independent for each label (sigmoid). Then entropy is summed over
+        the labels and margin is the distance of the least certain label from 0.5
+    :return: indices of the images, images without predictions last
+    """
+    probabilities = np.array(probabilities, dtype=float)
+    # single label is a yes/no prediction
+    if probabilities.shape[1] == 1:
+        probabilities = np.hstack([probabilities, 1 - probabilities])
+        multi_label = False
+
+    if multi_label:
+        p = np.clip(probabilities, 1e-12, 1 - 1e-12)
+        if method == 'margin':
+            uncertainty = 1 - np.min(np.abs(2 * probabilities - 1), axis=1)
+        else:
+            uncertainty = -np.sum(p * np.log(p) + (1 - p) * np.log(1 - p), axis=1)
+    elif method == 'margin':
+        top_two = np.sort(probabilities, axis=1)[:, -2:]
+        uncertainty = 1 - (top_two[:, 1] - top_two[:, 0])
+    else:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            p = probabilities / probabilities.sum(axis=1, keepdims=True)
+        uncertainty = -np.sum(p * np.log(np.clip(p, 1e-12, 1)), axis=1)
+
+    uncertainty[np.isnan(uncertainty)] = -np.inf
+    return np.argsort(-uncertainty, kind='stable')
+
+
+def suggest_labels(probabilities, labels, multi_label=False):
+    """
+    :param probabilities: predicted probabilities of one image
+    :param labels: all labels
+    :param multi_label: probabilities are independent for each label, see uncertainty_order
+    :return: labels with probability over SUGGESTION_THRESHOLD. For mutually exclusive labels the most probable
+        label is suggested if there are none. A single label and multi-label predictions may suggest nothing.
+    """
+    suggested = [label for label, p in zip(labels, probabilities) if p >= SUGGESTION_THRESHOLD]
+    if not suggested and not multi_label and len(labels) > 1:
+        suggested = [labels[int(np.argmax(probabilities))]]
+    return suggested
+
+
+def check_image_list(image_source, img_paths):
+    """
+    :return: if the listed images can be labeled. And error message
+    """
+    if len(img_paths) == 0:
+        return False, 'Directory with 0 images was selected'
+
+    # check that the DICOM files contain images (e.g. not reports), only the header of the first one is read
+    dicom_paths = [path for path in img_paths if path.lower().endswith('.dcm')]
+    if dicom_paths:
+        filename = os.path.split(dicom_paths[0])[-1]
+        try:
+            header = read_dicom_header(image_source, dicom_paths[0])
+        except Exception as e:
+            return False, f"{filename} can't be read as DICOM: {e}"
+        if 'Rows' not in header or 'Columns' not in header:
+            return False, f'{filename} is not a DICOM image'
+
+    return True, 'Images ok'
+
+
+class ListingThread(QThread):
+    """
+    Lists and checks the images in the background, listing a large bucket takes many requests
+    """
+    progress = pyqtSignal(int, int)
+
+    def __init__(self, image_source, sort_order):
+        super().__init__()
+        self.image_source = image_source
+        self.sort_order = sort_order
+
+        self.stopped = False
+        # results, available when the thread has finished
+        self.img_paths = []
+        self.error = None
+
+    def run(self):
+        try:
+            img_paths = self.image_source.list_images(progress=self.progress.emit,
+                                                      should_stop=lambda: self.stopped)
+        except OSError as e:
+            self.error = f'Images could not be listed: {e}'
+            return
+        if img_paths is None:
+            return
+
+        self.img_paths = sort_img_paths(img_paths, self.sort_order, self.image_source.locality_key)
+        images_ok, message = check_image_list(self.image_source, self.img_paths)
+        if not images_ok:
+            self.error = message
+
+    def stop(self):
+        """Stops listing after the current page"""
+        self.stopped = True
+
+
+class PrelabelThread(QThread):
+    """
+    Runs pre-labeling in the background so that the setup window stays responsive
+    """
+    progress = pyqtSignal(int, int)
+
+    def __init__(self, model, model_output, image_source, img_paths, num_labels, predictions_path):
+        super().__init__()
+        self.model = model
+        self.model_output = model_output
+        self.image_source = image_source
+        self.img_paths = img_paths
+        self.num_labels = num_labels
+        self.predictions_path = predictions_path
+
+        self.stopped = False
+        # results, available when the thread has finished
+        self.probabilities = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.probabilities = prelabel(self.model, self.image_source, self.img_paths, self.num_labels,
+                                          self.predictions_path, model_output=self.model_output,
+                                          progress=self.progress.emit, should_stop=lambda: self.stopped)
+        except Exception as e:
+            self.error = e
+
+    def stop(self):
+        """Stops pre-labeling without waiting for the tasks already running in the worker processes"""
+        self.stopped = True
+
+
 class SetupWindow(QWidget):
     def __init__(self):
         super().__init__()
@@ -47,6 +965,17 @@ class SetupWindow(QWidget):
 
         # State variables
         self.selected_folder = ''
+        self.image_source = None
+        self.img_paths = []
+        self.listed_folder = None  # location the images were listed from, the listing is reused until it changes
+        self.listing_thread = None
+        self.model = None  # optional model for pre-labeling, see load_model
+        self.sort_order = 'listing'  # traversal order of the images, see sort_img_paths
+        self.queue_order = 'entropy'  # uncertainty measure used to order pre-labeled images
+        self.model_output = 'probabilities'  # type of the model output, see to_probabilities
+        self.multi_label = False  # model predicts each label independently (sigmoid)
+        self.prelabel_thread = None
+        self.label_values = []
         self.selected_labels = ''
         self.num_labels = 0
         self.label_inputs = []
@@ -228,35 +1157,141 @@ class SetupWindow(QWidget):
             if label.text().strip() == '':
                 return False, 'All label fields has to be filled (step 3).'
 
-        # check that dir with images was selected
-        check_images = get_img_paths(self.selected_folder)
-        if len(check_images) == 0:
-            return False, 'Directory with 0 images was selected'
-
-
         return True, 'Form ok'
 
     def continue_app(self):
         """
-        If the setup form is valid, the LabelerWindow is opened and all necessary information is passed to it
+        If the setup form is valid, the LabelerWindow is opened and all necessary information is passed to it.
+        The images are listed first if the folder hasn't been listed yet.
         """
+        # listing or pre-labeling is already running
+        if self.listing_thread is not None or self.prelabel_thread is not None:
+            return
+
         form_is_valid, message = self.check_validity()
 
-        if form_is_valid:
-            label_values = []
+        if form_is_valid and self.listed_folder != self.selected_folder:
+            self.start_listing()
+        elif form_is_valid:
+            self.label_values = []
             for label in self.label_inputs:
-                label_values.append(label.text().strip())
+                self.label_values.append(label.text().strip())
 
-            self.close()
-            # show window in full-screen mode (window is maximized)
-            LabelerWindow(label_values, self.selected_folder).showMaximized()
+            if self.model is not None:
+                self.start_prelabeling()
+            else:
+                self.open_labeler(self.img_paths)
         else:
             self.error_message.setText(message)
 
+    def open_labeler(self, img_paths, suggestions=None):
+        self.close()
+        # show window in full-screen mode (window is maximized)
+        LabelerWindow(self.label_values, self.image_source, img_paths, suggestions).showMaximized()
+
+    def set_form_enabled(self, enabled):
+        for widget in (self.browse_button, self.browse_labels_button, self.confirm_num_labels, self.next_button,
+                       self.numLabelsInput, self.scroll):
+            widget.setEnabled(enabled)
+
+    def start_listing(self):
+        """
+        Lists the images of the selected folder. The form is disabled until it finishes.
+        """
+        if self.image_source is not None:
+            self.image_source.close()
+        self.image_source = get_image_source(self.selected_folder)
+        self.img_paths = []
+
+        self.set_form_enabled(False)
+        self.error_message.setText('Listing images')
+        self.listing_thread = ListingThread(self.image_source, self.sort_order)
+        self.listing_thread.progress.connect(self.show_listing_progress)
+        self.listing_thread.finished.connect(self.listing_finished)
+        self.listing_thread.start()
+
+    def show_listing_progress(self, pages, found):
+        self.error_message.setText(f'Listing images: {pages} pages, {found} images found')
+
+    def listing_finished(self):
+        """
+        Continues to labeling or pre-labeling with the listed images
+        """
+        thread = self.listing_thread
+        self.listing_thread = None
+        self.set_form_enabled(True)
+
+        # the window was closed while listing, see closeEvent
+        if thread.stopped:
+            self.close()
+            return
+        if thread.error is not None:
+            self.error_message.setText(thread.error)
+            return
+
+        self.img_paths = thread.img_paths
+        self.listed_folder = self.selected_folder
+        self.continue_app()
+
+    def start_prelabeling(self):
+        """
+        Starts predicting the labels with the model. The form is disabled until it finishes.
+        """
+        self.set_form_enabled(False)
+        self.show_prelabel_progress(0, len(self.img_paths))
+
+        predictions_path = os.path.join(self.image_source.output_folder, 'predicted_probabilities.npy')
+        self.prelabel_thread = PrelabelThread(self.model, self.model_output, self.image_source, self.img_paths,
+                                              len(self.label_values), predictions_path)
+        self.prelabel_thread.progress.connect(self.show_prelabel_progress)
+        self.prelabel_thread.finished.connect(self.prelabeling_finished)
+        self.prelabel_thread.start()
+
+    def show_prelabel_progress(self, done, total):
+        self.error_message.setText(f'Pre-labeling images: {done} of {total}')
+
+    def prelabeling_finished(self):
+        """
+        Orders the images by uncertainty and opens the LabelerWindow with the suggested labels
+        """
+        thread = self.prelabel_thread
+        self.prelabel_thread = None
+        self.set_form_enabled(True)
+
+        # the window was closed while pre-labeling, see closeEvent
+        if thread.stopped:
+            self.close()
+            return
+        if thread.error is not None:
+            self.error_message.setText(f'Pre-labeling failed: {thread.error}')
+            return
+
+        probabilities = thread.probabilities
+        multi_label = self.multi_label or self.model_output == 'sigmoid-logits'
+        img_paths = [self.img_paths[i] for i in uncertainty_order(probabilities, self.queue_order, multi_label)]
+        suggestions = {}
+        for path, image_probabilities in zip(self.img_paths, probabilities):
+            if not np.isnan(image_probabilities).any():
+                suggestions[os.path.split(path)[-1]] = suggest_labels(image_probabilities, self.label_values,
+                                                                      multi_label)
+        self.open_labeler(img_paths, suggestions)
+
+    def closeEvent(self, event):
+        """
+        Stops listing or pre-labeling if the window is closed while it is running. The window is only hidden
+        so that the GUI doesn't block, listing_finished or prelabeling_finished closes it when the thread
+        has stopped.
+        """
+        for thread in (self.listing_thread, self.prelabel_thread):
+            if thread is not None:
+                thread.stop()
+                self.hide()
+                event.ignore()
+
 
 class LabelerWindow(QMainWindow): #class LabelerWindow(QWidget):
 
-    def __init__(self, labels, input_folder):
+    def __init__(self, labels, image_source, img_paths, suggestions=None):
         super().__init__()
 
         # init UI state
@@ -271,12 +1306,15 @@ class LabelerWindow(QMainWindow): #class LabelerWindow(QWidget):
 
         # state variables
         self.counter = 0
-        self.input_folder = input_folder
-        self.img_paths = get_img_paths(input_folder)
+        self.image_source = image_source
+        self.scheduler = ReadScheduler(image_source)
+        self.img_paths = img_paths
         self.labels = labels
         self.num_labels = len(self.labels)
         self.num_images = len(self.img_paths)
         self.assigned_labels = {}
+        # labels predicted by the pre-labeling model {filename: labels}
+        self.suggestions = suggestions or {}
 
         # zoom factor for the image in labeler panel 
         self.scale_factor = 1.0
@@ -299,6 +1337,7 @@ class LabelerWindow(QMainWindow): #class LabelerWindow(QWidget):
         self.progress_bar = QLabel(self)
         self.curr_image_headline = QLabel('Current image:', self)
         self.labeled_percentage = QLabel(self)
+        self.read_stats_label = QLabel(self)
         self.csv_generated_message = QLabel(self)
         self.show_next_checkbox = QCheckBox("Automatically show next image when labeled", self)
 
@@ -331,7 +1370,10 @@ class LabelerWindow(QMainWindow): #class LabelerWindow(QWidget):
         # progress bar (how many images have I labeled so far)
         self.progress_bar.setGeometry(20, 65, self.img_panel_width, 20)
 
-        self.labeled_percentage.setGeometry(20, 85, self.img_panel_width, 20)
+        self.labeled_percentage.setGeometry(20, 85, 190, 20)
+
+        # read latency and prefetch depth
+        self.read_stats_label.setGeometry(220, 85, self.img_panel_width - 200, 20)
 
         # message that csv was generated
         self.csv_generated_message.setGeometry(self.img_panel_width + 30, 660, 800, 20)
@@ -339,6 +1381,7 @@ class LabelerWindow(QMainWindow): #class LabelerWindow(QWidget):
 
         # show image
         self.set_image(self.img_paths[0])
+        self.scheduler.prefetch(self.img_paths, 0, 1)
 
         # container for the image
         self.img_scroll_area.setGeometry(20, 120, self.img_panel_width, self.img_panel_height)
@@ -350,6 +1393,9 @@ class LabelerWindow(QMainWindow): #class LabelerWindow(QWidget):
         filename = os.path.split(path)[-1]
         self.img_name_label.setText(filename)
 
+        # show the labels suggested for the first image
+        self.set_button_color(filename)
+
         # progress bar
         self.progress_bar.setText(f'Image 1 of {self.num_images}')
 
@@ -448,8 +1494,9 @@ class LabelerWindow(QMainWindow): #class LabelerWindow(QWidget):
         self.viewMenu.addAction(self.zoom_out_action)
         self.menuBar().addMenu(self.viewMenu)
 
-    def scale_dicom(self, path):
-        """reads dicom pixels from a file and returns a scaled np array"""
+    @staticmethod
+    def scale_dicom(path):
+        """reads dicom pixels from a file (path or file object) and returns a scaled np array"""
         ds = dcmread(path)
         img = ds.pixel_array.astype(float)
         scaled = (np.maximum(img, 0) / img.max()) * 255.0
@@ -522,6 +1569,7 @@ class LabelerWindow(QMainWindow): #class LabelerWindow(QWidget):
             self.progress_bar.setText(f'Image {self.counter + 1} of {self.num_images}')
             self.set_button_color(filename)
             self.csv_generated_message.setText('')
+            self.scheduler.prefetch(self.img_paths, self.counter, 1)
 
         # change button color if this is last image in dataset
         elif self.counter == self.num_images - 1:
@@ -548,17 +1596,30 @@ class LabelerWindow(QMainWindow): #class LabelerWindow(QWidget):
 
                 self.set_button_color(filename)
                 self.csv_generated_message.setText('')
+                self.scheduler.prefetch(self.img_paths, self.counter, -1)
 
     def set_image(self, path):
         """
         displays the image in GUI
-        :param path: relative path to the image that should be show
+        :param path: relative path (or object key) to the image that should be show
         """
-        
+
+        # read the file (remote images are read from the local cache)
+        try:
+            img_bytes = self.image_source.read(path)
+        except OSError as e:
+            print("Can't load image:", e)
+            img_bytes = None
+        self.read_stats_label.setText(self.scheduler.stats_text())
+
+        # image couldn't be loaded, show empty image
+        if img_bytes is None:
+            pixmap = QPixmap()
+
         # image is DICOM convert to pixmap
-        if path.lower().endswith('.dcm'):
+        elif path.lower().endswith('.dcm'):
             # read and scale dicom image
-            img = self.scale_dicom(path)
+            img = self.scale_dicom(io.BytesIO(img_bytes))
             # convert to PIL image (workaround since converting a numpy array to pixmap is complex)
             img = Image.fromarray(img)
             # convert to pixmap
@@ -570,7 +1631,8 @@ class LabelerWindow(QMainWindow): #class LabelerWindow(QWidget):
 
         # image is not DICOM, create pixmap normally
         else:
-            pixmap = QPixmap(path)
+            pixmap = QPixmap()
+            pixmap.loadFromData(img_bytes)
         
         self.image_box.setPixmap(pixmap)
         self.image_box.adjustSize()
@@ -625,7 +1687,7 @@ class LabelerWindow(QMainWindow): #class LabelerWindow(QWidget):
         Assigned label is represented as one-hot vector.
         :param out_filename: name of csv file to be generated
         """
-        path_to_save = os.path.join(self.input_folder, 'output')
+        path_to_save = self.image_source.output_folder
         make_folder(path_to_save)
         csv_file_path = os.path.join(path_to_save, out_filename) + '.csv'
 
@@ -654,10 +1716,14 @@ class LabelerWindow(QMainWindow): #class LabelerWindow(QWidget):
             assigned_labels = self.assigned_labels[filename]
         else:
             assigned_labels = []
+        suggested_labels = self.suggestions.get(filename, [])
 
         for button in self.label_buttons:
             if button.text() in assigned_labels:
                 button.setStyleSheet('border: 1px solid #43A047; background-color: #4CAF50; color: white')
+            elif button.text() in suggested_labels:
+                # label suggested by the pre-labeling model
+                button.setStyleSheet('border: 2px dashed #4CAF50; background-color: None')
             else:
                 button.setStyleSheet('background-color: None')
 
@@ -668,6 +1734,11 @@ class LabelerWindow(QMainWindow): #class LabelerWindow(QWidget):
         """
         print("closing the App..")
         self.generate_csv('assigned_classes_automatically_generated')
+        self.image_source.close()
+
+        # show which files were slow to read
+        for path, latency in self.image_source.latency.slowest():
+            print(f'read {os.path.split(path)[-1]} in {1000 * latency:.1f} ms')
 
     def labels_to_zero_one(self, labels):
         """
@@ -698,7 +1769,31 @@ if __name__ == '__main__':
         app
     except:
         app = QApplication(sys.argv)
+
+        parser = argparse.ArgumentParser(description='Image annotation tool')
+        parser.add_argument('location', nargs='?', default='', help='folder or http(s) url of the images')
+        parser.add_argument('--model', help='ONNX model or module:function used to pre-label the images')
+        parser.add_argument('--model-output', choices=('probabilities', 'logits', 'sigmoid-logits'),
+                            default='probabilities',
+                            help='type of the model output: probabilities, logits of a softmax classifier '
+                                 '(or a single sigmoid output) or logits of a multi-label sigmoid classifier')
+        parser.add_argument('--multi-label', action='store_true',
+                            help='the model predicts each label independently (implied by sigmoid-logits)')
+        parser.add_argument('--order', choices=('entropy', 'margin'), default='entropy',
+                            help='uncertainty measure used to order the pre-labeled images')
+        parser.add_argument('--sort', choices=('listing', 'natural', 'locality'), default='listing',
+                            help='order of the images: as listed, natural filename order or order on disk')
+        args = parser.parse_args(app.arguments()[1:])
+
         ex = SetupWindow()
+        if args.location:
+            ex.selected_folder = args.location
+            ex.selected_folder_label.setText(ex.selected_folder)
+        ex.model = args.model
+        ex.queue_order = args.order
+        ex.model_output = args.model_output
+        ex.multi_label = args.multi_label
+        ex.sort_order = args.sort
         ex.show()
         sys.exit(app.exec_())
 
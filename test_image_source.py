@@ -0,0 +1,286 @@
+import http.server
+import io
+import tempfile
+import threading
+import unittest
+import urllib.parse
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from main import (PREFETCH_DEPTH, PREFETCH_MAX_DEPTH, PREFETCH_MIN_DEPTH, SLOW_READ_SECONDS, DiskByteCache,
+                  HttpImageSource, LatencyTracker, ReadScheduler, read_dicom_header, sort_img_paths)
+
+PAGE_SIZE = 10
+
+
+class FakeObjectStorage(http.server.BaseHTTPRequestHandler):
+    """
+    Stand-in for S3-compatible storage: paginated ListObjectsV2, GET with Range and ETag
+    """
+    protocol_version = 'HTTP/1.1'
+
+    objects = {}  # {key: bytes}
+    etags = {}  # {key: ETag}
+    no_range = set()  # keys for which the Range header is ignored
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        self.requests.append((url.path, query, self.headers.get('Range')))
+
+        if query.get('list-type') == '2':
+            prefix = query['prefix']
+            keys = sorted(key for key in self.objects if key.startswith(prefix) and '/' not in key[len(prefix):])
+            start = int(query.get('continuation-token', 0))
+            page = keys[start:start + PAGE_SIZE]
+            truncated = start + PAGE_SIZE < len(keys)
+
+            body = '<?xml version="1.0"?><ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            for key in page:
+                body += f'<Contents><Key>{key}</Key><ETag>{self.etags[key]}</ETag></Contents>'
+            body += f'<IsTruncated>{str(truncated).lower()}</IsTruncated>'
+            if truncated:
+                body += f'<NextContinuationToken>{start + PAGE_SIZE}</NextContinuationToken>'
+            body += '</ListBucketResult>'
+            self.send(200, body.encode())
+            return
+
+        key = urllib.parse.unquote(url.path).split('/', 2)[2]
+        if key not in self.objects:
+            self.send(404, b'')
+            return
+
+        data = self.objects[key]
+        headers = {'ETag': self.etags[key]}
+        byte_range = self.headers.get('Range')
+        if byte_range and key not in self.no_range:
+            start, end = (int(i) for i in byte_range[len('bytes='):].split('-'))
+            if start >= len(data):
+                self.send(416, b'')
+            else:
+                self.send(206, data[start:end + 1], headers)
+        else:
+            self.send(200, data, headers)
+
+
+def dicom_bytes():
+    ds = Dataset()
+    ds.PatientName = 'Test'
+    ds.Rows = 256
+    ds.Columns = 256
+    ds.SamplesPerPixel = 1
+    ds.BitsAllocated = 8
+    ds.BitsStored = 8
+    ds.HighBit = 7
+    ds.PixelRepresentation = 0
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.PixelData = bytes(256 * 256)
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = generate_uid()
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    f = io.BytesIO()
+    ds.save_as(f, write_like_original=False)
+    return f.getvalue()
+
+
+class HttpImageSourceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeObjectStorage)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        FakeObjectStorage.objects = {f'images/{i:03d}.png': bytes([i]) * 100 for i in range(25)}
+        FakeObjectStorage.objects['images/notes.txt'] = b'not an image'
+        FakeObjectStorage.objects['images/nested/000.png'] = b'nested'
+        FakeObjectStorage.objects['images/scan.dcm'] = dicom_bytes()
+        FakeObjectStorage.etags = {key: '"1"' for key in FakeObjectStorage.objects}
+        FakeObjectStorage.no_range = set()
+        FakeObjectStorage.requests = []
+
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.source = HttpImageSource(f'http://127.0.0.1:{self.server.server_port}/bucket/images',
+                                      cache_dir=self.cache_dir.name)
+
+    def tearDown(self):
+        self.source.close()
+        self.cache_dir.cleanup()
+
+    def test_list_images_follows_pagination(self):
+        progress = []
+        img_paths = self.source.list_images(progress=lambda pages, found: progress.append((pages, found)))
+
+        expected = [f'images/{i:03d}.png' for i in range(25)] + ['images/scan.dcm']
+        self.assertEqual(sorted(img_paths), sorted(expected))
+        self.assertEqual(len(FakeObjectStorage.requests), 3)
+        self.assertEqual([pages for pages, _ in progress], [1, 2, 3])
+        self.assertEqual(progress[-1][1], len(expected))
+
+    def test_list_images_stops_between_pages(self):
+        progress = []
+        img_paths = self.source.list_images(progress=lambda pages, found: progress.append(pages),
+                                            should_stop=lambda: len(progress) == 1)
+
+        self.assertIsNone(img_paths)
+        self.assertEqual(len(FakeObjectStorage.requests), 1)
+
+    def test_read_range(self):
+        key = 'images/001.png'
+        self.assertEqual(self.source.read_range(key, 10, 20), b'\x01' * 10)
+        self.assertEqual(FakeObjectStorage.requests[-1][2], 'bytes=10-19')
+
+        # server without range support sends the whole object
+        FakeObjectStorage.no_range.add(key)
+        self.assertEqual(self.source.read_range(key, 90, 200), b'\x01' * 10)
+
+        # range after the end of the object
+        FakeObjectStorage.no_range.clear()
+        self.assertEqual(self.source.read_range(key, 100, 200), b'')
+
+    def test_fetch_missing_object_raises(self):
+        with self.assertRaises(OSError):
+            self.source.fetch('images/missing.png')
+
+    def test_fetch_uses_cache_until_etag_changes(self):
+        self.source.list_images()
+        key = 'images/002.png'
+        self.assertEqual(self.source.read(key), b'\x02' * 100)
+        self.source.read(key)
+        self.assertEqual(sum(1 for path, _, _ in FakeObjectStorage.requests if path.endswith(key)), 1)
+
+        FakeObjectStorage.objects[key] = b'changed'
+        FakeObjectStorage.etags[key] = '"2"'
+        self.source.list_images()
+        self.assertEqual(self.source.read(key), b'changed')
+
+    def test_read_dicom_header_without_pixel_data(self):
+        header = read_dicom_header(self.source, 'images/scan.dcm', num_bytes=256)
+
+        self.assertEqual(header.Rows, 256)
+        self.assertNotIn('PixelData', header)
+        for _, _, byte_range in FakeObjectStorage.requests:
+            self.assertIsNotNone(byte_range)
+
+
+class DiskByteCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.cache = DiskByteCache(self.cache_dir.name, max_bytes=250)
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def test_least_recently_used_is_evicted(self):
+        for key in ('a.png', 'b.png', 'c.png'):
+            self.cache.put(key, bytes(100))
+        self.assertIsNone(self.cache.get('a.png'))
+        self.assertIsNotNone(self.cache.get('b.png'))
+
+    def test_held_file_is_not_evicted_until_released(self):
+        path = self.cache.put('a.png', bytes(100), hold=True)
+        self.cache.put('b.png', bytes(100))
+        self.cache.put('c.png', bytes(100))
+        self.assertTrue(self.cache.contains('a.png'))
+        self.assertFalse(self.cache.contains('b.png'))
+
+        self.cache.release(path)
+        self.cache.put('d.png', bytes(100))
+        self.assertFalse(self.cache.contains('a.png'))
+
+    def test_versions_are_cached_separately(self):
+        self.cache.put('a.png', b'old', version='"1"')
+        self.assertIsNone(self.cache.get('a.png', version='"2"'))
+
+
+class SortImgPathsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.img_paths = ['img10.png', 'IMG2.png', 'img1.png']
+
+    def test_listing_order_is_kept(self):
+        self.assertEqual(sort_img_paths(self.img_paths, 'listing'), self.img_paths)
+
+    def test_natural_order(self):
+        self.assertEqual(sort_img_paths(self.img_paths, 'natural'), ['img1.png', 'IMG2.png', 'img10.png'])
+
+    def test_locality_order(self):
+        positions = {'img10.png': 0, 'IMG2.png': 2, 'img1.png': 1}
+        self.assertEqual(sort_img_paths(self.img_paths, 'locality', positions.get),
+                         ['img10.png', 'img1.png', 'IMG2.png'])
+
+    def test_locality_without_key_falls_back_to_natural_order(self):
+        self.assertEqual(sort_img_paths(self.img_paths, 'locality', None), ['img1.png', 'IMG2.png', 'img10.png'])
+
+
+class FakeImageSource:
+    """
+    Records the prefetched paths, the latency is set by the test
+    """
+
+    def __init__(self, latencies=()):
+        self.latency = LatencyTracker()
+        for seconds in latencies:
+            self.latency.record('image.png', seconds)
+        self.prefetched = []
+
+    def prefetch(self, paths):
+        self.prefetched.append(list(paths))
+
+
+class ReadSchedulerTest(unittest.TestCase):
+
+    def test_default_depth_without_samples(self):
+        self.assertEqual(ReadScheduler(FakeImageSource()).depth, PREFETCH_DEPTH)
+
+    def test_fast_storage_uses_min_depth(self):
+        self.assertEqual(ReadScheduler(FakeImageSource([0.0001])).depth, PREFETCH_MIN_DEPTH)
+
+    def test_depth_grows_with_latency(self):
+        scheduler = ReadScheduler(FakeImageSource([2.5 * SLOW_READ_SECONDS]))
+        self.assertEqual(scheduler.depth, 3 * PREFETCH_MIN_DEPTH)
+
+    def test_slow_storage_is_capped_at_max_depth(self):
+        self.assertEqual(ReadScheduler(FakeImageSource([10.0])).depth, PREFETCH_MAX_DEPTH)
+
+    def test_forward_window(self):
+        image_source = FakeImageSource([0.0001])
+        img_paths = [f'{i}.png' for i in range(10)]
+        ReadScheduler(image_source).prefetch(img_paths, 3, 1)
+        self.assertEqual(image_source.prefetched, [img_paths[4:4 + PREFETCH_MIN_DEPTH]])
+
+    def test_backward_window_is_nearest_first(self):
+        image_source = FakeImageSource([0.0001])
+        img_paths = [f'{i}.png' for i in range(10)]
+        scheduler = ReadScheduler(image_source)
+
+        scheduler.prefetch(img_paths, 5, -1)
+        scheduler.prefetch(img_paths, 1, -1)
+        scheduler.prefetch(img_paths, 0, -1)
+        self.assertEqual(image_source.prefetched, [img_paths[5 - PREFETCH_MIN_DEPTH:5][::-1], ['0.png'], []])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image
+
+from main import LocalImageSource, prelabel, suggest_labels, to_probabilities, uncertainty_order
+
+
+def predict(images):
+    """
+    Stand-in model for the worker processes: the probability of the first label is the mean brightness
+    """
+    brightness = images.mean(axis=(1, 2, 3))
+    return np.stack([brightness, 1 - brightness], axis=1)
+
+
+class UncertaintyOrderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.probabilities = np.array([[0.9, 0.1],
+                                       [np.nan, np.nan],
+                                       [0.5, 0.5],
+                                       [0.7, 0.3]])
+
+    def test_entropy_order_with_failed_images_last(self):
+        self.assertEqual(list(uncertainty_order(self.probabilities, 'entropy')), [2, 3, 0, 1])
+
+    def test_margin_order_with_failed_images_last(self):
+        self.assertEqual(list(uncertainty_order(self.probabilities, 'margin')), [2, 3, 0, 1])
+
+    def test_single_label(self):
+        probabilities = np.array([[0.99], [0.4], [np.nan], [0.1]])
+        for method in ('entropy', 'margin'):
+            self.assertEqual(list(uncertainty_order(probabilities, method)), [1, 3, 0, 2])
+
+    def test_multi_label(self):
+        # both labels are certain in the first image although the probabilities don't sum to one
+        probabilities = np.array([[0.99, 0.99], [0.6, 0.99]])
+        self.assertEqual(list(uncertainty_order(probabilities, 'entropy', multi_label=True)), [1, 0])
+
+
+class ToProbabilitiesTest(unittest.TestCase):
+
+    def test_single_logit_uses_sigmoid(self):
+        probabilities = to_probabilities(np.array([[0.0], [np.log(3)]]), 'logits')
+        np.testing.assert_allclose(probabilities, [[0.5], [0.75]])
+
+    def test_logits_use_softmax(self):
+        probabilities = to_probabilities(np.array([[1.0, 1.0], [0.0, np.log(3)]]), 'logits')
+        np.testing.assert_allclose(probabilities, [[0.5, 0.5], [0.25, 0.75]])
+
+    def test_output_outside_0_1_is_not_probabilities(self):
+        with self.assertRaises(ValueError):
+            to_probabilities(np.array([[2.0, -1.0]]), 'probabilities')
+
+
+class SuggestLabelsTest(unittest.TestCase):
+
+    def test_most_probable_label_is_suggested(self):
+        self.assertEqual(suggest_labels([0.3, 0.2], ['a', 'b']), ['a'])
+
+    def test_single_label_below_threshold(self):
+        self.assertEqual(suggest_labels([0.1], ['tumor']), [])
+
+    def test_multi_label_below_threshold(self):
+        self.assertEqual(suggest_labels([0.1, 0.2], ['a', 'b'], multi_label=True), [])
+
+
+class PrelabelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        for i, color in enumerate((0, 255, 51)):
+            Image.new('RGB', (16, 16), (color,) * 3).save(os.path.join(self.folder.name, f'{i}.png'))
+        with open(os.path.join(self.folder.name, '3.png'), 'wb') as f:
+            f.write(b'not an image')
+        self.source = LocalImageSource(self.folder.name)
+
+    def tearDown(self):
+        self.source.close()
+        self.folder.cleanup()
+
+    def test_undecodable_image_is_nan(self):
+        img_paths = sorted(self.source.list_images())
+        predictions_path = os.path.join(self.folder.name, 'output', 'predictions.npy')
+        progress = []
+
+        probabilities = prelabel('test_prelabel:predict', self.source, img_paths, 2, predictions_path,
+                                 progress=lambda done, total: progress.append((done, total)), workers=2)
+
+        np.testing.assert_allclose(probabilities[:3], [[0, 1], [1, 0], [0.2, 0.8]], atol=1e-6)
+        self.assertTrue(np.isnan(probabilities[3]).all())
+        self.assertEqual(progress[-1], (4, 4))
+
+
+if __name__ == '__main__':
+    unittest.main()